@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+#
+#
+# Copyright 2020 Spectric Labs Inc (www.spectric.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Input and output conditioning for the vocoder.
+
+The chip only speaks 8 kHz int16 in blocks of 160 samples.  InputConditioner
+takes audio at any rate, as float or int16, and produces (n, 160) int16 blocks
+for AmbeServer.encode_speech_batch.  OutputConditioner does the reverse for
+decoded PCM.  Both carry their filter state across calls so files can be
+processed in chunks.
+"""
+
+import math
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+SAMPLE_RATE = 8000
+BLOCK_SAMPLES = 160
+
+###############################################################################
+# Format Conversion
+def to_int16(x):
+    """
+    Converts float audio in [-1.0, 1.0] to int16, clipping out of range
+    samples.  int16 input is returned unchanged.
+    """
+    x = numpy.asarray(x)
+    if x.dtype == numpy.int16:
+        return x
+    return numpy.clip(numpy.rint(x * 32768.0), -32768, 32767).astype(numpy.int16)
+
+def to_float32(x):
+    """
+    Converts int16 audio to float32 in [-1.0, 1.0).  Float input is
+    returned as float32.
+    """
+    x = numpy.asarray(x)
+    if x.dtype.kind == "f":
+        return x.astype(numpy.float32, copy=False)
+    return x.astype(numpy.float32) * numpy.float32(1.0 / 32768.0)
+
+###############################################################################
+# Resampling
+class Resampler(object):
+    """
+    Streaming polyphase FIR resampler between integer sample rates.
+
+    The windowed-sinc prototype is split into up phases.  Outputs sharing
+    a phase read input windows at a fixed stride, so each phase is one
+    matrix-vector product over a strided view of the input.  taps sets the
+    filter length in samples of the lower of the two rates, so the
+    transition band stays the same width relative to the cutoff whatever
+    the ratio.  Input history is carried to the next call to process().
+    """
+
+    def __init__(self, in_rate, out_rate, taps=32, cutoff=0.9, beta=8.0):
+        g = math.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+
+        # Prototype filter at the upsampled rate, gain up to make up for the
+        # inserted zeros
+        n = taps * max(self.up, self.down)
+        fc = 0.5 * cutoff / max(self.up, self.down)
+        t = numpy.arange(n) - (n - 1) / 2.0
+        h = 2 * fc * numpy.sinc(2 * fc * t) * numpy.kaiser(n, beta)
+        h *= self.up / h.sum()
+
+        # bank[p, k] weights input sample base - taps + 1 + k for output
+        # phase p, so it lines up with a window of the input
+        self.taps = -(-n // self.up)
+        h = numpy.concatenate((h, numpy.zeros(self.taps * self.up - n)))
+        bank = h.reshape(self.taps, self.up).T[:, ::-1]
+        self.bank = numpy.ascontiguousarray(bank, dtype=numpy.float32)
+        self.reset()
+
+    def reset(self):
+        self._hist = numpy.zeros(self.taps - 1, dtype=numpy.float32)
+        self._consumed = 0
+        self._next = 0
+
+    def process(self, x):
+        """
+        Resamples the next chunk of float samples.
+        """
+        x = numpy.asarray(x, dtype=numpy.float32)
+        buf = numpy.concatenate((self._hist, x))
+        end = self._consumed + len(x)
+
+        # Number of outputs whose newest input is available
+        count = max(0, -(-(end * self.up - self._next) // self.down))
+        y = numpy.empty(count, dtype=numpy.float32)
+        if count:
+            windows = sliding_window_view(buf, self.taps)
+
+        for r in range(min(self.up, count)):
+            t = self._next + r * self.down
+            start = t // self.up - self._consumed
+            num = len(range(r, count, self.up))
+            rows = windows[start:start + (num - 1) * self.down + 1:self.down]
+            y[r::self.up] = rows @ self.bank[t % self.up]
+
+        self._next += count * self.down
+        self._consumed = end
+        self._hist = buf[len(buf) - (self.taps - 1):]
+        return y
+
+###############################################################################
+# Gain
+class Agc(object):
+    """
+    Block automatic gain control.  Gain moves towards the level that brings
+    each 160 sample block to target_dbfs, quickly when reducing gain and
+    slowly when increasing it.  Blocks below floor_dbfs hold the gain.
+    """
+
+    def __init__(self, target_dbfs=-18.0, max_gain_db=30.0, floor_dbfs=-60.0,
+                 attack=0.5, release=0.05):
+        self.target_dbfs = target_dbfs
+        self.max_gain_db = max_gain_db
+        self.floor_dbfs = floor_dbfs
+        self.attack = attack
+        self.release = release
+        self.gain_db = 0.0
+
+    def process(self, blocks):
+        """
+        Applies gain in place to an (n, 160) float array of blocks.
+        """
+        rms = numpy.sqrt(numpy.mean(numpy.square(blocks), axis=1))
+        level = 20 * numpy.log10(numpy.maximum(rms, 1e-9))
+        gains = numpy.empty(len(blocks), dtype=numpy.float32)
+
+        gain_db = self.gain_db
+        for idx, lvl in enumerate(level):
+            if lvl > self.floor_dbfs:
+                want = min(self.target_dbfs - lvl, self.max_gain_db)
+                rate = self.attack if want < gain_db else self.release
+                gain_db += rate * (want - gain_db)
+            gains[idx] = gain_db
+        self.gain_db = gain_db
+
+        blocks *= numpy.power(10.0, gains / 20.0)[:, None]
+        return blocks
+
+###############################################################################
+# Stages
+class InputConditioner(object):
+    """
+    Converts audio at in_rate into 8 kHz int16 blocks for encode_speech.
+    Samples that do not fill a block are carried to the next call.
+    """
+
+    def __init__(self, in_rate, gain_db=0.0, agc=None, **kwargs):
+        self.resampler = None
+        if in_rate != SAMPLE_RATE:
+            self.resampler = Resampler(in_rate, SAMPLE_RATE, **kwargs)
+        self.gain = numpy.float32(10 ** (gain_db / 20.0))
+        self.agc = agc
+        self._pending = numpy.zeros(0, dtype=numpy.float32)
+
+    def process(self, x):
+        """
+        Returns an (n, 160) int16 array of the complete blocks available.
+        """
+        x = to_float32(x)
+        if self.resampler is not None:
+            x = self.resampler.process(x)
+
+        x = numpy.concatenate((self._pending, x))
+        full = len(x) // BLOCK_SAMPLES * BLOCK_SAMPLES
+        self._pending = x[full:]
+        return self._condition(x[:full].reshape(-1, BLOCK_SAMPLES))
+
+    def flush(self):
+        """
+        Zero pads any carried samples out to a final block.
+        """
+        blocks = numpy.zeros((1 if len(self._pending) else 0, BLOCK_SAMPLES),
+                             dtype=numpy.float32)
+        blocks.ravel()[:len(self._pending)] = self._pending
+        self._pending = numpy.zeros(0, dtype=numpy.float32)
+        return self._condition(blocks)
+
+    def _condition(self, blocks):
+        blocks = blocks * self.gain
+        if self.agc is not None:
+            self.agc.process(blocks)
+        return to_int16(blocks)
+
+class OutputConditioner(object):
+    """
+    Converts decoded 8 kHz int16 PCM to float32 at out_rate.
+    """
+
+    def __init__(self, out_rate, gain_db=0.0, **kwargs):
+        self.resampler = None
+        if out_rate != SAMPLE_RATE:
+            self.resampler = Resampler(SAMPLE_RATE, out_rate, **kwargs)
+        self.gain = numpy.float32(10 ** (gain_db / 20.0))
+
+    def process(self, pcm):
+        """
+        Accepts an int16 array, or a sequence of SpeechPCMResp containers.
+        """
+        if not isinstance(pcm, numpy.ndarray):
+            pcm = numpy.frombuffer(b"".join(r.BYTES for r in pcm), dtype=numpy.int16)
+
+        x = to_float32(pcm.ravel()) * self.gain
+        if self.resampler is not None:
+            x = self.resampler.process(x)
+        return x.astype(numpy.float32, copy=False)
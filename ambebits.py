@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+#
+# Copyright 2020 Spectric Labs Inc (www.spectric.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Vectorized bit handling for 72-bit DMR AMBE+2 frames.
+
+Everything here works on whole arrays of frames at once.  Bit arrays are
+uint8 arrays holding one bit per element, MSB first, and packed frames are
+(n, 9) uint8 arrays ready to be handed to AmbeServer.decode_ambe.
+"""
+
+import numpy
+
+FRAME_BITS = 72
+FRAME_BYTES = 9
+
+# A DMR voice burst is 264 bits: 108 voice bits, 48 sync/embedded bits,
+# then 108 more voice bits carrying three 72-bit AMBE frames.
+BURST_BITS = 264
+
+###############################################################################
+# FEC Tables
+
+# The 72 frame bits are interleaved four ways, C0 (Golay 24,12) takes every
+# fourth bit starting at 0, and so on.  MMDVMHost DMR_A/B/C_TABLE.
+DMR_INTERLEAVE = numpy.arange(FRAME_BITS).reshape(18, 4).T.ravel()
+DMR_A = DMR_INTERLEAVE[:24]
+DMR_B = DMR_INTERLEAVE[24:47]
+DMR_C = DMR_INTERLEAVE[47:]
+
+GOLAY_POLY = 0xC75
+
+def _golay_syndrome(cw):
+    for bit in range(22, 10, -1):
+        if cw & (1 << bit):
+            cw ^= GOLAY_POLY << (bit - 11)
+    return cw
+
+def _build_golay_tables():
+    # Golay(23,12) is perfect, so every syndrome maps to exactly one error
+    # pattern of weight three or less
+    errors = numpy.zeros(2048, dtype=numpy.uint32)
+    weights = numpy.zeros(2048, dtype=numpy.uint8)
+    for i in range(23):
+        for j in range(i, 23):
+            for k in range(j, 23):
+                pattern = (1 << i) | (1 << j) | (1 << k)
+                syndrome = _golay_syndrome(pattern)
+                weight = bin(pattern).count("1")
+                if weights[syndrome] == 0 and syndrome != 0:
+                    errors[syndrome] = pattern
+                    weights[syndrome] = weight
+    return errors, weights
+
+def _build_prng_table():
+    # C1 is scrambled with a sequence seeded from the 12 data bits of C0
+    table = numpy.zeros(4096, dtype=numpy.uint32)
+    for seed in range(4096):
+        pr = 16 * seed
+        mask = 0
+        for _ in range(23):
+            pr = (173 * pr + 13849) % 65536
+            mask = (mask << 1) | (pr >> 15)
+        table[seed] = mask
+    return table
+
+GOLAY_ERRORS, GOLAY_WEIGHTS = _build_golay_tables()
+PRNG_TABLE = _build_prng_table()
+
+# Syndromes are linear, so split the 23-bit word into high and low halves
+# and look each up separately
+_SYNDROME_HI = numpy.array(
+    [_golay_syndrome(v << 11) for v in range(4096)], dtype=numpy.uint32
+)
+_SYNDROME_LO = numpy.arange(2048, dtype=numpy.uint32)
+
+_POPCOUNT = numpy.array([bin(v).count("1") for v in range(256)], dtype=numpy.uint8)
+
+###############################################################################
+# Bit Packing
+def dibits_to_bits(dibits):
+    """
+    Expands an (..., n) array of dibits into an (..., 2n) array of bits.
+    """
+    dibits = numpy.asarray(dibits, dtype=numpy.uint8)
+    bits = numpy.empty(dibits.shape[:-1] + (dibits.shape[-1] * 2,), dtype=numpy.uint8)
+    bits[..., 0::2] = (dibits >> 1) & 1
+    bits[..., 1::2] = dibits & 1
+    return bits
+
+def burst_frames(bursts):
+    """
+    Extracts the three AMBE frames from each DMR voice burst.
+
+    bursts is an (n, 264) array of bits or an (n, 132) array of dibits.
+    Returns an (3n, 72) array of bits in burst order.
+    """
+    bursts = numpy.asarray(bursts, dtype=numpy.uint8)
+    if bursts.ndim == 1:
+        bursts = bursts.reshape(1, -1)
+    if bursts.shape[-1] == BURST_BITS // 2:
+        bursts = dibits_to_bits(bursts)
+    if bursts.shape[-1] != BURST_BITS:
+        raise ValueError("expected bursts of %d bits" % BURST_BITS)
+
+    voice = numpy.concatenate((bursts[:, :108], bursts[:, 156:]), axis=1)
+    return voice.reshape(-1, FRAME_BITS)
+
+def pack_frames(bits):
+    """
+    Packs an (n, 72) array of bits into an (n, 9) array of frame bytes.
+    """
+    bits = numpy.asarray(bits, dtype=numpy.uint8).reshape(-1, FRAME_BITS)
+    return numpy.packbits(bits, axis=1)
+
+def unpack_frames(frames):
+    """
+    Unpacks an (n, 9) array of frame bytes into an (n, 72) array of bits.
+    """
+    frames = numpy.asarray(frames, dtype=numpy.uint8).reshape(-1, FRAME_BYTES)
+    return numpy.unpackbits(frames, axis=1)
+
+def unpack_channel_resp(resps):
+    """
+    Unpacks a sequence of ChannelResp containers into an (n, NUM_BITS) array
+    of bits.  All responses must carry the same number of bits.
+    """
+    resps = list(resps)
+    if not resps:
+        return numpy.zeros((0, FRAME_BITS), dtype=numpy.uint8)
+
+    num_bits = resps[0].NUM_BITS
+    data = numpy.frombuffer(b"".join(r.BYTES for r in resps), dtype=numpy.uint8)
+    bits = numpy.unpackbits(data.reshape(len(resps), -1), axis=1)
+    return bits[:, :num_bits]
+
+###############################################################################
+# FEC Pre-check
+def fec_errors(frames):
+    """
+    Estimates the bit errors in C0 and C1 of each (n, 9) frame.
+
+    C0 is Golay(24,12) and C1 is scrambled Golay(23,12).  An error count of 4
+    in C0 means the frame was uncorrectable.  C2 and C3 are unprotected.
+    """
+    bits = unpack_frames(frames)
+    n = len(bits)
+
+    # Deinterleaving is a transpose of the 18x4 bit matrix, after which C0
+    # is bytes 0-2 and C1 the top 23 bits of bytes 3-5
+    packed = numpy.packbits(
+        bits.reshape(n, 18, 4).transpose(0, 2, 1).reshape(n, FRAME_BITS), axis=1
+    )
+    a_bytes = packed[:, 0:3].astype(numpy.uint32)
+    a = (a_bytes[:, 0] << 16) | (a_bytes[:, 1] << 8) | a_bytes[:, 2]
+    b_bytes = packed[:, 3:6].astype(numpy.uint32)
+    b = ((b_bytes[:, 0] << 16) | (b_bytes[:, 1] << 8) | b_bytes[:, 2]) >> 1
+
+    a23 = a >> 1
+    syndrome = _SYNDROME_HI[a23 >> 11] ^ _SYNDROME_LO[a23 & 0x7FF]
+    weight = GOLAY_WEIGHTS[syndrome]
+    parity = (_POPCOUNT[packed[:, 0]] + _POPCOUNT[packed[:, 1]]
+              + _POPCOUNT[packed[:, 2]] + weight) & 1
+    errs_a = weight + parity
+
+    data = (a23 ^ GOLAY_ERRORS[syndrome]) >> 11
+    b = b ^ PRNG_TABLE[data]
+    syndrome = _SYNDROME_HI[b >> 11] ^ _SYNDROME_LO[b & 0x7FF]
+    errs_b = GOLAY_WEIGHTS[syndrome]
+
+    return errs_a, errs_b
+
+def lost_frames(frames, max_errors=6):
+    """
+    Returns a boolean mask of frames too corrupt to send to the chip as
+    voice.  These should be decoded with lost_frame=True instead.
+    """
+    errs_a, errs_b = fec_errors(frames)
+    return (errs_a > 3) | (errs_a.astype(numpy.uint16) + errs_b > max_errors)
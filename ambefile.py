@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+#
+# Copyright 2020 Spectric Labs Inc (www.spectric.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Memory-mapped sources and sinks for AmbeServer.decode_ambe_batch and
+AmbeServer.encode_speech_batch.
+
+Sources are iterables of frames or 160 sample blocks backed by a memory map,
+and sinks preallocate their output file and copy each response straight into
+a memory map, so archives stream at constant memory.
+"""
+
+import os
+import struct
+import numpy
+
+FRAME_BYTES = 9
+BLOCK_SAMPLES = 160
+
+# Responses carry 156 to 164 samples when SPCHFMT is not fixed at 160
+MAX_BLOCK_SAMPLES = 164
+SAMPLE_RATE = 8000
+
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+
+# RIFF sizes are 32-bit, larger files are written as RF64 with the real
+# sizes in a ds64 chunk (EBU Tech 3306)
+RF64_HEADER = struct.Struct("<4sI4s4sIQQQI4sIHHIIHH4sI")
+RF64_SIZE = 0xFFFFFFFF
+RIFF_LIMIT = RF64_SIZE
+
+def _memmap(path, dtype, mode, offset, count):
+    if count == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(count,))
+
+def _as_samples(block):
+    # Accepts a SpeechPCMResp container, raw native int16 bytes or an array
+    if hasattr(block, "BYTES"):
+        block = block.BYTES
+    if isinstance(block, (bytes, bytearray, memoryview)):
+        return numpy.frombuffer(block, dtype=numpy.int16)
+    return numpy.asarray(block).astype(numpy.int16, copy=False)
+
+###############################################################################
+# Sources
+class AmbeFrameReader(object):
+    """
+    Raw AMBE frame dump, one fixed size frame after another.  Iterating
+    yields (9,) uint8 views into the memory map.
+    """
+
+    def __init__(self, path, offset=0, frame_bytes=FRAME_BYTES):
+        self.path = path
+        count = (os.path.getsize(path) - offset) // frame_bytes
+        self.frames = _memmap(path, numpy.uint8, "r", offset, count * frame_bytes)
+        self.frames = self.frames.reshape(count, frame_bytes)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+class PcmReader(object):
+    """
+    Raw 16-bit PCM file.  Iterating yields 160 sample blocks, with the last
+    partial block zero padded.
+    """
+
+    def __init__(self, path, offset=0, count=None, dtype="<i2", rate=SAMPLE_RATE):
+        self.path = path
+        self.rate = rate
+        if count is None:
+            count = (os.path.getsize(path) - offset) // numpy.dtype(dtype).itemsize
+        self.samples = _memmap(path, dtype, "r", offset, count)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def blocks(self, size=BLOCK_SAMPLES):
+        full = len(self.samples) // size
+        for idx in range(full):
+            yield self.samples[idx * size:(idx + 1) * size]
+
+        tail = self.samples[full * size:]
+        if len(tail):
+            block = numpy.zeros(size, dtype=self.samples.dtype)
+            block[:len(tail)] = tail
+            yield block
+
+    def __iter__(self):
+        return self.blocks()
+
+class WavReader(PcmReader):
+    """
+    Mono 16-bit PCM WAV file.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+            if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+                raise ValueError("%s is not a WAV file" % path)
+
+            fmt = None
+            ds64_len = None
+            while True:
+                hdr = f.read(8)
+                if len(hdr) < 8:
+                    raise ValueError("%s has no data chunk" % path)
+
+                chunk_id, chunk_len = struct.unpack("<4sI", hdr)
+                if chunk_id == b"ds64":
+                    _, ds64_len = struct.unpack("<QQ", f.read(16))
+                    f.seek(chunk_len - 16 + (chunk_len & 1), os.SEEK_CUR)
+                elif chunk_id == b"fmt ":
+                    fmt = struct.unpack("<HHIIHH", f.read(16))
+                    f.seek(chunk_len - 16 + (chunk_len & 1), os.SEEK_CUR)
+                elif chunk_id == b"data":
+                    offset = f.tell()
+                    break
+                else:
+                    f.seek(chunk_len + (chunk_len & 1), os.SEEK_CUR)
+
+        if fmt is None:
+            raise ValueError("%s has no fmt chunk" % path)
+
+        audio_fmt, channels, rate, _, _, bits = fmt
+        if audio_fmt != 1 or channels != 1 or bits != 16:
+            raise ValueError("%s is not mono 16-bit PCM" % path)
+
+        if riff == b"RF64" and chunk_len == RF64_SIZE:
+            if ds64_len is None:
+                raise ValueError("%s has no ds64 chunk" % path)
+            chunk_len = ds64_len
+
+        # Streams that were never finalized leave the data length unset
+        count = min(chunk_len, os.path.getsize(path) - offset) // 2
+        super(WavReader, self).__init__(path, offset, count, "<i2", rate)
+
+###############################################################################
+# Sinks
+class WavWriter(object):
+    """
+    Mono 16-bit PCM WAV file preallocated for num_samples.  Each write()
+    copies a decoded block straight into the memory map.  On close() the
+    file is truncated to the samples actually written.
+
+    Responses are not always 160 samples, so preallocate
+    MAX_BLOCK_SAMPLES per frame when SPCHFMT allows other sizes.  Files
+    too large for RIFF size fields are written as RF64.
+    """
+
+    def __init__(self, path, num_samples, rate=SAMPLE_RATE):
+        self.path = path
+        self.rate = rate
+        self.pos = 0
+
+        self.rf64 = WAV_HEADER.size - 8 + num_samples * 2 > RIFF_LIMIT
+        self.header = RF64_HEADER if self.rf64 else WAV_HEADER
+
+        with open(path, "wb") as f:
+            f.write(self._header(num_samples))
+            f.truncate(self.header.size + num_samples * 2)
+
+        self.samples = _memmap(path, "<i2", "r+", self.header.size, num_samples)
+
+    def _header(self, num_samples):
+        data_len = num_samples * 2
+        if self.rf64:
+            return RF64_HEADER.pack(
+                b"RF64", RF64_SIZE, b"WAVE",
+                b"ds64", 28, RF64_HEADER.size - 8 + data_len, data_len, num_samples, 0,
+                b"fmt ", 16, 1, 1, self.rate, self.rate * 2, 2, 16,
+                b"data", RF64_SIZE
+            )
+
+        return WAV_HEADER.pack(
+            b"RIFF", WAV_HEADER.size - 8 + data_len, b"WAVE",
+            b"fmt ", 16, 1, 1, self.rate, self.rate * 2, 2, 16,
+            b"data", data_len
+        )
+
+    def write(self, block):
+        samples = _as_samples(block)
+        end = self.pos + len(samples)
+        if end > len(self.samples):
+            raise ValueError("WAV file preallocated for %d samples" % len(self.samples))
+
+        self.samples[self.pos:end] = samples
+        self.pos = end
+
+    def close(self):
+        if isinstance(self.samples, numpy.memmap):
+            self.samples.flush()
+        self.samples = numpy.zeros(0, dtype="<i2")
+
+        with open(self.path, "r+b") as f:
+            f.write(self._header(self.pos))
+            f.truncate(self.header.size + self.pos * 2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class AmbeFrameWriter(object):
+    """
+    Raw AMBE frame dump preallocated for num_frames.  Accepts ChannelResp
+    containers or frame bytes.
+    """
+
+    def __init__(self, path, num_frames, frame_bytes=FRAME_BYTES):
+        self.path = path
+        self.frame_bytes = frame_bytes
+        self.pos = 0
+
+        with open(path, "wb") as f:
+            f.truncate(num_frames * frame_bytes)
+
+        self.frames = _memmap(path, numpy.uint8, "r+", 0, num_frames * frame_bytes)
+
+    def write(self, frame):
+        if hasattr(frame, "BYTES"):
+            frame = frame.BYTES
+        end = self.pos + self.frame_bytes
+        if end > len(self.frames):
+            raise ValueError("frame file preallocated for %d frames"
+                             % (len(self.frames) // self.frame_bytes))
+
+        self.frames[self.pos:end] = numpy.frombuffer(frame, dtype=numpy.uint8)
+        self.pos = end
+
+    def close(self):
+        if isinstance(self.frames, numpy.memmap):
+            self.frames.flush()
+        self.frames = numpy.zeros(0, dtype=numpy.uint8)
+
+        with open(self.path, "r+b") as f:
+            f.truncate(self.pos)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -16,6 +16,10 @@
 # limitations under the License.
 
 import os
+import fcntl
+import array
+import select
+import socket
 import termios
 import struct
 import logging
@@ -24,6 +28,9 @@ import tty
 import time
 import serial
 import math
+import gc
+import tracemalloc
+import collections
 import construct as c
 import numpy
 
@@ -408,6 +415,486 @@ DV3K_CONTROL_CHANFMT = b'\x15'
 
 SERIAL_BAUD=460800 
 
+SILENCE = bytes(160 * 2)
+FRAME_MS = 20
+
+ToneEvent = collections.namedtuple("ToneEvent", ["start", "frames"])
+
+def is_tone_frame(resp):
+    """
+    True if a SpeechPCMResp carries DCMODE_OUT with TONE_FRAME set.  The
+    chip only reports DCMODE when enabled with set_spchfmt.
+    """
+    return resp.CMODE is not None and resp.CMODE.DCMODE_OUT.TONE_FRAME
+
+def add_tone_frame(tones, idx):
+    """
+    Records frame idx as a tone frame in a list of ToneEvents, extending the
+    last event if it ends at idx.
+    """
+    if tones and tones[-1].start + tones[-1].frames == idx:
+        tones[-1] = ToneEvent(tones[-1].start, tones[-1].frames + 1)
+    else:
+        tones.append(ToneEvent(idx, 1))
+
+###############################################################################
+# Transports
+class Transport(object):
+    """
+    Byte stream to the device.  Subclasses implement _recv() and write(),
+    and reads are served from a buffer so the small reads in get_response
+    cost no system calls once a response has arrived.
+    """
+
+    timeout = 5.0
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def _recv(self, timeout):
+        raise NotImplementedError
+
+    def read(self, size):
+        deadline = None
+        while len(self._buf) < size:
+            if deadline is None:
+                deadline = time.monotonic() + self.timeout
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            chunk = self._recv(remaining)
+            if not chunk:
+                break
+            self._buf += chunk
+
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Discards any buffered input
+        """
+        self._buf.clear()
+
+    def close(self):
+        pass
+
+class SerialTransport(Transport):
+    """
+    pyserial backed transport
+    """
+
+    def __init__(self, device, baudrate=SERIAL_BAUD, timeout=5.0):
+        super(SerialTransport, self).__init__()
+        self.timeout = timeout
+        self.port = serial.Serial(
+            device,
+            baudrate=baudrate,
+            timeout=timeout,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            xonxoff=False,
+            rtscts=False,
+            dsrdtr=False)
+
+    def read(self, size):
+        return self.port.read(size)
+
+    def write(self, data):
+        return self.port.write(data)
+
+    def flush(self):
+        self.port.flushInput()
+        self.port.flushOutput()
+
+    def close(self):
+        self.port.close()
+
+# linux/serial.h
+TIOCGSERIAL = 0x541E
+TIOCSSERIAL = 0x541F
+ASYNC_LOW_LATENCY = 0x2000
+
+class FdTransport(Transport):
+    """
+    Raw file descriptor transport configured with termios and polled with
+    select.poll, bypassing pyserial.
+
+    With low_latency the FTDI latency_timer is set to 1 ms and the tty is
+    flagged ASYNC_LOW_LATENCY.  The default 16 ms latency timer otherwise
+    dominates the round trip of every frame.  Both need permissions that
+    may not be available, so failures are logged and ignored.
+    """
+
+    def __init__(self, device, baudrate=SERIAL_BAUD, timeout=5.0,
+                 low_latency=False, logger=None):
+        super(FdTransport, self).__init__()
+        self.device = device
+        self.timeout = timeout
+        self.log = logger
+        if self.log is None:
+            self.log = logging.getLogger("Modem")
+
+        self.fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self.fd)
+
+        speed = getattr(termios, "B%d" % baudrate)
+        attrs = termios.tcgetattr(self.fd)
+        attrs[0] &= ~(termios.IXON | termios.IXOFF | termios.IXANY)
+        attrs[2] &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB
+                      | termios.CRTSCTS)
+        attrs[2] |= termios.CS8 | termios.CLOCAL | termios.CREAD
+        attrs[4] = speed
+        attrs[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+        if low_latency:
+            self.set_low_latency()
+
+    def set_low_latency(self):
+        name = os.path.basename(os.path.realpath(self.device))
+        timer = "/sys/bus/usb-serial/devices/%s/latency_timer" % name
+        try:
+            with open(timer, "w") as f:
+                f.write("1")
+        except OSError as e:
+            self.log.warning("Failed to set %s: %s", timer, e)
+
+        try:
+            buf = array.array("i", [0] * 32)
+            fcntl.ioctl(self.fd, TIOCGSERIAL, buf)
+            buf[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(self.fd, TIOCSSERIAL, buf)
+        except OSError as e:
+            self.log.warning("Failed to set ASYNC_LOW_LATENCY: %s", e)
+
+    def _recv(self, timeout):
+        if not self.poller.poll(timeout * 1000):
+            return b""
+        return os.read(self.fd, 4096)
+
+    def write(self, data):
+        """
+        Writes data, waiting up to timeout for the tty to drain whenever it
+        is full.  Returns the number of bytes written, which is short if
+        the tty stalled.
+        """
+        view = memoryview(data)
+        deadline = None
+        while view:
+            try:
+                view = view[os.write(self.fd, view):]
+                continue
+            except BlockingIOError:
+                pass
+
+            if deadline is None:
+                deadline = time.monotonic() + self.timeout
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            _, writable, _ = select.select([], [self.fd], [], remaining)
+            if not writable:
+                break
+
+        return len(data) - len(view)
+
+    def flush(self):
+        super(FdTransport, self).flush()
+        termios.tcflush(self.fd, termios.TCIOFLUSH)
+
+    def close(self):
+        os.close(self.fd)
+
+class SocketTransport(Transport):
+    """
+    TCP or UDP transport, for network attached vocoders such as AMBEserver
+    """
+
+    def __init__(self, host, port, udp=False, timeout=5.0):
+        super(SocketTransport, self).__init__()
+        self.timeout = timeout
+        if udp:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect((host, port))
+        else:
+            self.sock = socket.create_connection((host, port), timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _recv(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(4096)
+        except socket.timeout:
+            return b""
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+
+class LoopbackTransport(Transport):
+    """
+    In-memory transport.  Written packets are passed to responder and
+    whatever it returns is queued to be read back.  Without a responder
+    writes are echoed.
+    """
+
+    def __init__(self, responder=None):
+        super(LoopbackTransport, self).__init__()
+        self.responder = responder
+        self._pending = collections.deque()
+
+    def _recv(self, timeout):
+        if not self._pending:
+            return b""
+        return self._pending.popleft()
+
+    def write(self, data):
+        resp = data if self.responder is None else self.responder(bytes(data))
+        if resp:
+            self._pending.append(bytes(resp))
+        return len(data)
+
+    def flush(self):
+        super(LoopbackTransport, self).flush()
+        self._pending.clear()
+
+###############################################################################
+# Result Cache
+class AmbeFrameCache(object):
+    """
+    Bounded LRU cache of decoded AMBE frames.
+
+    The vocoder is stateful, so the PCM returned for a frame depends on the
+    frames that came before it.  A cache hit replays the first result seen
+    for that frame, which is only acceptable for offline jobs that tolerate
+    that approximation (archive transcodes with long idle or silent runs).
+    It is never enabled unless passed to AmbeServer explicitly.
+
+    Entries are keyed on the frame bytes plus the active rate, DCMODE and
+    SPCHFMT configuration, and store the raw response payload.  When path
+    is given the cache is loaded from it on construction and written by
+    save().  The file is a magic string followed by length prefixed key
+    and payload records.
+    """
+
+    MAGIC = b"AMBECACHE1"
+    RECORD = struct.Struct(">HH")
+
+    def __init__(self, max_entries=4096, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+        if self.path is not None and os.path.exists(self.path):
+            self.load(self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            data = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            blob = f.read()
+
+        if not blob.startswith(self.MAGIC):
+            raise ValueError("%s is not an AMBE frame cache" % path)
+
+        offset = len(self.MAGIC)
+        while offset < len(blob):
+            if offset + self.RECORD.size > len(blob):
+                raise ValueError("%s is truncated" % path)
+            key_len, data_len = self.RECORD.unpack_from(blob, offset)
+            offset += self.RECORD.size
+
+            end = offset + key_len + data_len
+            if end > len(blob):
+                raise ValueError("%s is truncated" % path)
+            self.put(blob[offset:offset + key_len], blob[offset + key_len:end])
+            offset = end
+
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            raise ValueError("no path to save cache to")
+
+        with open(path, "wb") as f:
+            f.write(self.MAGIC)
+            for key, data in self._entries.items():
+                f.write(self.RECORD.pack(len(key), len(data)))
+                f.write(key)
+                f.write(data)
+
+###############################################################################
+# Profiling
+class AllocationProfile(object):
+    """
+    tracemalloc profile of the packet hot path, for tracking down growth in
+    long running daemons.  Use as a context manager from
+    AmbeServer.profile().  Every response read starts a new frame.
+
+    Two figures are kept per frame.  alloc_bytes_per_frame is how far traced
+    memory rises within each frame (building, writing, reading, parsing and
+    the sink), which is what allocation regressions show up in.  The
+    retained figures compare snapshots from entry and exit, and should stay
+    near zero unless something holds on to frames.
+
+    tracing is only started and stopped here if the host process was not
+    already tracing, but the traced peak is reset at every frame.
+    """
+
+    def __init__(self, server=None, traceback_depth=1):
+        self.server = server
+        self.traceback_depth = traceback_depth
+        self.frames = 0
+        self.peak = 0
+        self.alloc_bytes = 0
+        self.max_alloc_bytes = 0
+        self.stats = []
+        self.types = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.frames = 0
+        self.alloc_bytes = 0
+        self.max_alloc_bytes = 0
+
+        gc.collect()
+        self._types = None
+        self._snapshot = None
+        self._types = self._count_types()
+
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start(self.traceback_depth)
+        self._snapshot = self._take_snapshot()
+
+        tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        if self.server is not None:
+            self.server.profiler = self
+
+    def frame(self):
+        """
+        Closes the current frame and starts the next.  Called by
+        AmbeServer.read_packet.
+        """
+        self._end_frame()
+        self.frames += 1
+
+    def _end_frame(self):
+        current, peak = tracemalloc.get_traced_memory()
+        alloc = peak - self._base
+        self.alloc_bytes += alloc
+        self.max_alloc_bytes = max(self.max_alloc_bytes, alloc)
+        self.peak = max(self.peak, peak)
+
+        tracemalloc.reset_peak()
+        self._base = current
+
+    def stop(self):
+        if self.server is not None:
+            self.server.profiler = None
+        self._end_frame()
+
+        gc.collect()
+        snapshot = self._take_snapshot()
+        if self._started:
+            tracemalloc.stop()
+
+        # The profiler's own Snapshot and Traceback objects are skipped by
+        # _count_types, and counting after the exit snapshot keeps the
+        # counts themselves out of the retained figures
+        types = self._count_types()
+        types.subtract(self._types)
+        self.types = [(name, count) for name, count in types.most_common() if count > 0]
+
+        self.stats = snapshot.compare_to(self._snapshot, "lineno")
+        self._snapshot = None
+        self._types = None
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+
+    def _count_types(self):
+        own = {id(self._types), id(self._snapshot)}
+        counts = collections.Counter()
+        for obj in gc.get_objects():
+            if id(obj) in own or type(obj).__module__ == "tracemalloc":
+                continue
+            counts[type(obj).__name__] += 1
+        return counts
+
+    @property
+    def alloc_bytes_per_frame(self):
+        return self.alloc_bytes / max(self.frames, 1)
+
+    @property
+    def retained_blocks_per_frame(self):
+        return sum(stat.count_diff for stat in self.stats) / max(self.frames, 1)
+
+    @property
+    def retained_bytes_per_frame(self):
+        return sum(stat.size_diff for stat in self.stats) / max(self.frames, 1)
+
+    def report(self, limit=10):
+        lines = [
+            "frames %d, peak %d bytes" % (self.frames, self.peak),
+            "allocated %.1f bytes per frame, %d at most"
+            % (self.alloc_bytes_per_frame, self.max_alloc_bytes),
+            "retained %.1f blocks, %.1f bytes per frame"
+            % (self.retained_blocks_per_frame, self.retained_bytes_per_frame),
+        ]
+        for stat in self.stats[:limit]:
+            lines.append("  %s" % stat)
+        for name, count in self.types[:limit]:
+            lines.append("  %s +%d" % (name, count))
+        return "\n".join(lines)
+
 class AmbeServer(object):
     """
     https://www.dvsinc.com/manuals/AMBE-3000R_manual.pdf
@@ -415,14 +902,26 @@ class AmbeServer(object):
     Section 6.5
     """
 
-    def __init__(self, device=None, logger=None):
-        if device is None:
+    def __init__(self, device=None, logger=None, cache=None, transport=None):
+        if device is None and transport is None:
             for dev in os.listdir("/dev/serial/by-id/"):
                 if dev.startswith("usb-FTDI_ZUM_AMBE3000_"):
                     device = os.path.join("/dev/serial/by-id/", dev)
                     break
 
         self.device = device
+        self.transport = transport
+        self.cache = cache
+
+        # Active configuration, tracked so cached results are keyed on it
+        self.rate_idx = None
+        self.dcmode = None
+        self.spchfmt = None
+
+        # Built tone packets keyed on (tone_idx, tone_amp)
+        self._tone_packets = {}
+
+        self.profiler = None
 
         self.log = logger
         if self.log is None:
@@ -433,25 +932,21 @@ class AmbeServer(object):
         """
         Opens the serial port to the device
         """
-        self.port = serial.Serial(
-            self.device,
-            baudrate=SERIAL_BAUD,
-            timeout=5.0,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            xonxoff=False,
-            rtscts=False,
-            dsrdtr=False)
-	
-        self.port.flushInput()
-        self.port.flushOutput()
+        self.port = SerialTransport(self.device)
+        self.port.flush()
 
     def send_packet(self, pkt_type, fields, resp_type, resp):
         """
         Sends a command packet to the device.
         """
-        cmd = GeneralPacket.build(
+        self.write_packet(self.build_packet(pkt_type, fields))
+        return self.read_packet(resp_type, resp)
+
+    def build_packet(self, pkt_type, fields):
+        """
+        Frames fields into a packet ready for write_packet.
+        """
+        return GeneralPacket.build(
             dict(
                 LENGTH=len(fields),
                 TYPE=pkt_type,
@@ -460,12 +955,23 @@ class AmbeServer(object):
             )
         )
 
+    def write_packet(self, cmd):
+        """
+        Writes a built packet without waiting for the response.
+        """
         self.log.debug("writing %s", binascii.hexlify(cmd))
         
         numout = self.port.write(cmd)
         if numout != len(cmd):
             self.log.warning("Failed to write command")
 
+    def read_packet(self, resp_type, resp):
+        """
+        Reads the next response and parses it with resp.
+        """
+        if self.profiler is not None:
+            self.profiler.frame()
+
         frame_type, data = self.get_response()
         if frame_type != PacketType.build(resp_type):
             self.log.warning("Unexpected frame_type returned")
@@ -553,6 +1059,10 @@ class AmbeServer(object):
             self.log.warning("DV3K not ready after reset")
             return False
         
+        # The chip is back to its defaults
+        self.rate_idx = None
+        self.dcmode = None
+        self.spchfmt = None
         return True
 
     def get_prod_id(self):
@@ -608,6 +1118,8 @@ class AmbeServer(object):
             self.log.warning("DV3K failed to set ratet")
             return None
         
+        if resp.RESULT == 0:
+            self.rate_idx = rate_idx
         return resp.RESULT == 0
 
     def set_chanfmt(self, ecmode, samples):
@@ -676,6 +1188,8 @@ class AmbeServer(object):
             self.log.warning("DV3K failed to set command")
             return None
         
+        if resp.RESULT == 0:
+            self.spchfmt = spchfmt
         return resp.RESULT == 0
 
     def set_ecmode(self, **kwargs):
@@ -718,6 +1232,8 @@ class AmbeServer(object):
             self.log.warning("DV3K failed to set command")
             return None
         
+        if resp.RESULT == 0:
+            self.dcmode = struct.unpack(">H", cmd[1:])[0]
         return resp.RESULT == 0
 
     def get_readcfg(self):
@@ -786,9 +1302,97 @@ class AmbeServer(object):
         
         return resp
 
-    def decode_ambe(self, ambe):
+    def tone_packet(self, tone_idx, tone_amp):
+        """
+        Returns the built packet for a tone frame, reusing it for repeats.
+        """
+        key = (tone_idx, tone_amp)
+        cmd = self._tone_packets.get(key)
+        if cmd is None:
+            speech = SpeechPCMPacket.build(
+                dict(
+                    SPEECHD = dict(
+                        NUM_SAMPLES=160,
+                        DATA=[0] * 160,
+
+                    ),
+                    CMODE=dict(
+                        CMODE_IN=dict(
+                            TS_ENABLE=True,
+                        ),
+                    ),
+                    TONE=dict(
+                        TONE_IDX = tone_idx,
+                        TONE_AMPLITUDE = tone_amp 
+                    ),
+                )
+            )
+            cmd = self.build_packet(PacketType.SPEECH, speech)
+            self._tone_packets[key] = cmd
+
+        return cmd
+
+    def encode_tones(self, schedule, sink, depth=4):
+        """
+        Encodes a schedule of (tone_idx, tone_amp, duration_ms) entries and
+        writes the responses to sink.  Each duration is rounded up to whole
+        20 ms frames.  Up to depth packets are written ahead of their
+        responses so the chip is never left idle waiting on the host.
+        """
+        count = 0
+        pending = 0
+        for tone_idx, tone_amp, duration in schedule:
+            cmd = self.tone_packet(tone_idx, tone_amp)
+            for _ in range(int(math.ceil(duration / FRAME_MS))):
+                self.write_packet(cmd)
+                pending += 1
+                if pending < depth:
+                    continue
+
+                count += self._sink_channel_resp(sink)
+                pending -= 1
+
+        for _ in range(pending):
+            count += self._sink_channel_resp(sink)
+
+        return count
+
+    def _sink_channel_resp(self, sink):
+        resp = self.read_packet("CHANNEL", ChannelResp)
+        if not resp:
+            self.log.warning("DV3K failed to send tone")
+            return 0
+
+        sink.write(resp)
+        return 1
+
+    def cache_key(self, ambe, lost_frame=False):
+        """
+        Key for a frame under the active configuration.  Settings that were
+        never sent are packed as 0xFFFF.
+        """
+        return bytes(ambe) + struct.pack(
+            ">?HHH",
+            lost_frame,
+            0xFFFF if self.rate_idx is None else self.rate_idx,
+            0xFFFF if self.dcmode is None else self.dcmode,
+            0xFFFF if self.spchfmt is None else self.spchfmt,
+        )
+
+    def decode_ambe(self, ambe, lost_frame=False):
+        """
+        Decodes one 9-byte frame.  Tone events are only collected by
+        decode_ambe_batch; callers decoding frame by frame can get the same
+        events with is_tone_frame(resp) and add_tone_frame(tones, idx).
+        """
         assert len(ambe) == 9
 
+        if self.cache is not None:
+            key = self.cache_key(ambe, lost_frame)
+            data = self.cache.get(key)
+            if data is not None:
+                return SpeechPCMResp.parse(data)
+
         chan = ChannelDefaultVocoderPacket.build(
             dict(
                 CHAND = dict(
@@ -797,7 +1401,11 @@ class AmbeServer(object):
 
                 ),
                 CHAND4=None,
-                CMODE=None,
+                CMODE=dict(
+                    CMODE_IN=dict(
+                        LOST_FRAME=True,
+                    ),
+                ) if lost_frame else None,
                 TONE=None,
                 NUM_SAMPLES=None
             )
@@ -814,7 +1422,62 @@ class AmbeServer(object):
             self.log.warning("DV3K failed to send channel")
             return None
         
+        if self.cache is not None and resp:
+            self.cache.put(key, SpeechPCMResp.build(resp))
+
         return resp
 
+    def decode_ambe_batch(self, frames, sink, lost=None, tones=None):
+        """
+        Decodes each 9-byte frame in frames and writes the responses to
+        sink.  Frames that fail to decode are written as silence to keep
+        the output aligned.  lost is an optional mask of frames to send as
+        LOST_FRAME, see ambebits.lost_frames.  If tones is a list, runs of
+        TONE_FRAME responses are appended to it as ToneEvents.
+        """
+        count = 0
+        for idx, frame in enumerate(frames):
+            lost_frame = bool(lost[idx]) if lost is not None else False
+            resp = self.decode_ambe(bytes(frame), lost_frame=lost_frame)
+            if not resp:
+                sink.write(SILENCE)
+                continue
+
+            if tones is not None and is_tone_frame(resp):
+                add_tone_frame(tones, idx)
+
+            sink.write(resp)
+            count += 1
+
+        return count
+
+    def encode_speech_batch(self, blocks, sink):
+        """
+        Encodes each block of 160 int16 samples in blocks and writes the
+        responses to sink.
+        """
+        count = 0
+        for block in blocks:
+            pcm16 = numpy.asarray(block, dtype=numpy.int16).view(numpy.uint16)
+            resp = self.encode_speech(pcm16.tolist())
+            if not resp:
+                continue
+
+            sink.write(resp)
+            count += 1
+
+        return count
+
+    def profile(self, **kwargs):
+        """
+        Returns an AllocationProfile that counts this server's frames while
+        active.
+        """
+        return AllocationProfile(self, **kwargs)
+
     def open(self):
-        self.open_serial()
+        if self.transport is None:
+            self.open_serial()
+        else:
+            self.port = self.transport
+            self.port.flush()
@@ -0,0 +1,60 @@
+import numpy
+import pytest
+
+import ambeaudio
+
+
+def tone(freq, rate, seconds=1.0, amp=0.5):
+    t = numpy.arange(int(rate * seconds)) / rate
+    return (amp * numpy.sin(2 * numpy.pi * freq * t)).astype(numpy.float32)
+
+
+def amplitude(y, skip=1000):
+    y = y[skip:]
+    return numpy.sqrt(2 * numpy.mean(numpy.square(y, dtype=numpy.float64)))
+
+
+@pytest.mark.parametrize("rate", [48000, 44100])
+def test_resampler_rejects_aliases(rate):
+    # 5 kHz folds to 3 kHz at 8 kHz, it must be at least 60 dB down
+    y = ambeaudio.Resampler(rate, 8000).process(tone(5000, rate))
+    assert amplitude(y) < 0.5e-3
+
+
+@pytest.mark.parametrize("rate", [48000, 44100])
+def test_resampler_passes_speech_band(rate):
+    y = ambeaudio.Resampler(rate, 8000).process(tone(1000, rate))
+    assert abs(amplitude(y) - 0.5) < 0.01
+
+
+@pytest.mark.parametrize("in_rate,out_rate", [
+    (48000, 8000), (44100, 8000), (8000, 48000), (8000, 44100),
+])
+def test_resampler_streaming_matches_one_shot(in_rate, out_rate):
+    x = numpy.random.default_rng(0).standard_normal(in_rate).astype(numpy.float32)
+
+    one_shot = ambeaudio.Resampler(in_rate, out_rate).process(x)
+    resampler = ambeaudio.Resampler(in_rate, out_rate)
+    chunks = [resampler.process(c) for c in numpy.array_split(x, 37)]
+    chunks.append(resampler.process(numpy.zeros(0, dtype=numpy.float32)))
+
+    streamed = numpy.concatenate(chunks)
+    assert len(streamed) == len(one_shot) == len(x) * out_rate // in_rate
+    assert numpy.allclose(streamed, one_shot, atol=1e-5)
+
+
+def test_input_conditioner_blocks():
+    cond = ambeaudio.InputConditioner(48000)
+    x = tone(440, 48000, seconds=0.5)
+
+    blocks = [cond.process(c) for c in numpy.array_split(x, 13)]
+    blocks.append(cond.flush())
+    blocks = numpy.concatenate(blocks)
+
+    assert blocks.dtype == numpy.int16
+    assert blocks.shape == (25, ambeaudio.BLOCK_SAMPLES)
+
+
+def test_to_int16_clips():
+    x = numpy.array([-2.0, -1.0, 0.0, 0.5, 2.0], dtype=numpy.float32)
+    assert list(ambeaudio.to_int16(x)) == [-32768, -32768, 0, 16384, 32767]
@@ -0,0 +1,114 @@
+import numpy
+
+import ambebits
+
+
+def golay23(data):
+    parity = data << 11
+    for bit in range(22, 10, -1):
+        if parity & (1 << bit):
+            parity ^= 0xC75 << (bit - 11)
+    return (data << 11) | parity
+
+
+def golay24(data):
+    cw = golay23(data)
+    return (cw << 1) | (bin(cw).count("1") & 1)
+
+
+def make_frame(data_a, data_b, rng):
+    a = golay24(data_a)
+    b = golay23(data_b) ^ int(ambebits.PRNG_TABLE[data_a])
+
+    bits = numpy.zeros(72, dtype=numpy.uint8)
+    bits[ambebits.DMR_A] = [(a >> (23 - i)) & 1 for i in range(24)]
+    bits[ambebits.DMR_B] = [(b >> (22 - i)) & 1 for i in range(23)]
+    bits[ambebits.DMR_C] = rng.integers(0, 2, 25)
+    return bits
+
+
+def make_frames(count=64):
+    rng = numpy.random.default_rng(0)
+    data = rng.integers(0, 4096, (count, 2))
+    return numpy.array([make_frame(int(a), int(b), rng) for a, b in data])
+
+
+def test_golay_reference_codewords():
+    # MMDVMHost ENCODING_TABLE_23127[1] and ENCODING_TABLE_24128[1]
+    assert golay23(1) == 0xC75
+    assert golay24(1) == 0x18EB
+
+
+def test_interleave_matches_mmdvmhost_tables():
+    assert list(ambebits.DMR_A) == [
+        0, 4, 8, 12, 16, 20, 24, 28, 32, 36, 40, 44,
+        48, 52, 56, 60, 64, 68, 1, 5, 9, 13, 17, 21,
+    ]
+    assert list(ambebits.DMR_B) == [
+        25, 29, 33, 37, 41, 45, 49, 53, 57, 61, 65, 69,
+        2, 6, 10, 14, 18, 22, 26, 30, 34, 38, 42,
+    ]
+    assert list(ambebits.DMR_C) == [
+        46, 50, 54, 58, 62, 66, 70, 3, 7, 11, 15, 19, 23,
+        27, 31, 35, 39, 43, 47, 51, 55, 59, 63, 67, 71,
+    ]
+
+
+def test_fec_errors_clean_frames():
+    errs_a, errs_b = ambebits.fec_errors(ambebits.pack_frames(make_frames()))
+    assert not errs_a.any()
+    assert not errs_b.any()
+
+
+def test_fec_errors_counts_injected_errors():
+    bits = make_frames()
+    for count in range(4):
+        corrupt = bits.copy()
+        corrupt[:, ambebits.DMR_A[:count]] ^= 1
+        corrupt[:, ambebits.DMR_B[23 - count:]] ^= 1
+
+        errs_a, errs_b = ambebits.fec_errors(ambebits.pack_frames(corrupt))
+        assert (errs_a == count).all()
+        assert (errs_b == count).all()
+
+
+def test_lost_frames_flags_uncorrectable_c0():
+    bits = make_frames()
+    bits[::2, ambebits.DMR_A[:4]] ^= 1
+
+    lost = ambebits.lost_frames(ambebits.pack_frames(bits))
+    assert lost[::2].all()
+    assert not lost[1::2].any()
+
+
+def test_burst_frames_skips_sync():
+    bursts = numpy.zeros((2, 264), dtype=numpy.uint8)
+    bursts[:, 108:156] = 1
+    bursts[1, 0] = 1
+    bursts[1, 107] = 1
+    bursts[1, 156] = 1
+    bursts[1, 263] = 1
+
+    frames = ambebits.burst_frames(bursts)
+    assert frames.shape == (6, 72)
+    assert not frames[:3].any()
+    assert frames[3, 0] == 1
+    assert frames[4, 35] == 1
+    assert frames[4, 36] == 1
+    assert frames[5, 71] == 1
+    assert frames.sum() == 4
+
+
+def test_burst_frames_accepts_dibits():
+    rng = numpy.random.default_rng(1)
+    bits = rng.integers(0, 2, (4, 264)).astype(numpy.uint8)
+    dibits = bits[:, 0::2] << 1 | bits[:, 1::2]
+
+    assert (ambebits.burst_frames(dibits) == ambebits.burst_frames(bits)).all()
+
+
+def test_pack_round_trip():
+    bits = make_frames(8)
+    frames = ambebits.pack_frames(bits)
+    assert frames.shape == (8, 9)
+    assert (ambebits.unpack_frames(frames) == bits).all()
@@ -0,0 +1,58 @@
+import wave
+
+import numpy
+
+import ambefile
+
+
+def ramp(count):
+    return (numpy.arange(count) * 37 % 65536 - 32768).astype(numpy.int16)
+
+
+def test_wav_round_trip(tmp_path):
+    path = str(tmp_path / "out.wav")
+    samples = ramp(1000)
+
+    with ambefile.WavWriter(path, 2000) as wav:
+        for block in numpy.array_split(samples, 7):
+            wav.write(block)
+
+    with wave.open(path) as w:
+        assert w.getnframes() == 1000
+        assert w.getframerate() == ambefile.SAMPLE_RATE
+
+    assert (ambefile.WavReader(path).samples == samples).all()
+
+
+def test_wav_writer_switches_to_rf64(tmp_path, monkeypatch):
+    monkeypatch.setattr(ambefile, "RIFF_LIMIT", 1000)
+    path = str(tmp_path / "out.wav")
+    samples = ramp(600)
+
+    with ambefile.WavWriter(path, 600) as wav:
+        assert wav.rf64
+        wav.write(samples)
+
+    with open(path, "rb") as f:
+        assert f.read(4) == b"RF64"
+    assert (ambefile.WavReader(path).samples == samples).all()
+
+
+def test_wav_writer_accepts_variable_blocks(tmp_path):
+    path = str(tmp_path / "out.wav")
+    blocks = [ramp(n) for n in (156, 164, 160)]
+
+    with ambefile.WavWriter(path, 3 * ambefile.MAX_BLOCK_SAMPLES) as wav:
+        for block in blocks:
+            wav.write(block)
+
+    assert len(ambefile.WavReader(path)) == 156 + 164 + 160
+
+
+def test_frame_reader_blocks(tmp_path):
+    path = tmp_path / "frames.ambe"
+    path.write_bytes(bytes(range(27)) + b"\x00")
+
+    frames = ambefile.AmbeFrameReader(str(path))
+    assert len(frames) == 3
+    assert bytes(frames[2]) == bytes(range(18, 27))
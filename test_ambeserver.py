@@ -0,0 +1,366 @@
+import logging
+import os
+import pty
+import socket
+import struct
+import time
+import tracemalloc
+
+import pytest
+
+import ambeserver
+
+
+def pcm_packet(flags=None):
+    fields = b"\x00\xa0" + bytes(320)
+    if flags is not None:
+        fields += b"\x02" + struct.pack(">H", flags)
+    return b"\x61" + struct.pack(">H", len(fields)) + b"\x02" + fields
+
+
+def channel_packet(frame):
+    fields = b"\x01\x48" + frame
+    return b"\x61" + struct.pack(">H", len(fields)) + b"\x01" + fields
+
+
+class FakeChip(object):
+    """
+    LoopbackTransport responder that acknowledges control packets and
+    answers every channel packet with a block of silence.
+    """
+
+    def __init__(self):
+        self.spchfmt = 0
+        self.channel_packets = 0
+        self.speech_packets = []
+
+    def __call__(self, pkt):
+        if pkt[3] == 0x00:
+            if pkt[4] == 0x33:
+                self.spchfmt = 0
+                return b"\x61\x00\x01\x00\x39"
+            if pkt[4] == 0x16:
+                self.spchfmt = struct.unpack(">H", pkt[5:7])[0]
+            return b"\x61\x00\x02\x00" + pkt[4:5] + b"\x00"
+
+        if pkt[3] == 0x02:
+            self.speech_packets.append(pkt)
+            return channel_packet(bytes([len(self.speech_packets) % 256]) * 9)
+
+        self.channel_packets += 1
+        return pcm_packet(0 if self.spchfmt & 0x01 else None)
+
+
+class ListSink(list):
+    def write(self, block):
+        self.append(block)
+
+
+def make_server(chip=None, **kwargs):
+    svr = ambeserver.AmbeServer(
+        transport=ambeserver.LoopbackTransport(chip or FakeChip()), **kwargs
+    )
+    svr.open()
+    return svr
+
+
+def test_cache_hits_skip_the_chip():
+    chip = FakeChip()
+    cache = ambeserver.AmbeFrameCache(max_entries=2)
+    svr = make_server(chip, cache=cache)
+
+    for _ in range(3):
+        assert svr.decode_ambe(bytes(9)) is not None
+
+    assert chip.channel_packets == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_key_tracks_spchfmt():
+    chip = FakeChip()
+    svr = make_server(chip, cache=ambeserver.AmbeFrameCache())
+
+    assert svr.decode_ambe(bytes(9)).CMODE is None
+    assert svr.set_spchfmt("always", "never")
+    assert svr.decode_ambe(bytes(9)).CMODE is not None
+    assert chip.channel_packets == 2
+
+
+def test_cache_key_cleared_by_reset():
+    chip = FakeChip()
+    svr = make_server(chip, cache=ambeserver.AmbeFrameCache())
+    default_key = svr.cache_key(bytes(9))
+
+    assert svr.set_spchfmt("always", "never")
+    assert svr.decode_ambe(bytes(9)).CMODE is not None
+    assert svr.cache_key(bytes(9)) != default_key
+
+    assert svr.reset()
+    assert svr.cache_key(bytes(9)) == default_key
+    assert svr.decode_ambe(bytes(9)).CMODE is None
+    assert chip.channel_packets == 2
+
+
+def test_cache_round_trips_through_file(tmp_path):
+    path = str(tmp_path / "frames.cache")
+    cache = ambeserver.AmbeFrameCache(path=path)
+    svr = make_server(cache=cache)
+    svr.decode_ambe(bytes(9))
+    svr.decode_ambe(b"\x01" * 9, lost_frame=True)
+    cache.save()
+
+    loaded = ambeserver.AmbeFrameCache(path=path)
+    assert list(loaded._entries.items()) == list(cache._entries.items())
+
+
+def test_cache_rejects_foreign_files(tmp_path):
+    path = tmp_path / "frames.cache"
+    path.write_bytes(b"\x80\x04not a cache")
+
+    with pytest.raises(ValueError):
+        ambeserver.AmbeFrameCache(path=str(path))
+
+
+class ToneChip(FakeChip):
+    """
+    Flags TONE_FRAME on the channel packets numbered in tone_packets.
+    """
+
+    def __init__(self, tone_packets):
+        super(ToneChip, self).__init__()
+        self.tone_packets = tone_packets
+
+    def __call__(self, pkt):
+        if pkt[3] != 0x01:
+            return super(ToneChip, self).__call__(pkt)
+
+        flags = 0x8000 if self.channel_packets in self.tone_packets else 0
+        self.channel_packets += 1
+        return pcm_packet(flags)
+
+
+def test_decode_batch_reports_tone_runs():
+    svr = make_server(ToneChip({1, 2, 3, 6}))
+    tones = []
+
+    assert svr.decode_ambe_batch([bytes(9)] * 8, ListSink(), tones=tones) == 8
+    assert tones == [ambeserver.ToneEvent(1, 3), ambeserver.ToneEvent(6, 1)]
+
+
+def test_add_tone_frame_by_hand():
+    svr = make_server(ToneChip({0, 1, 4}))
+    tones = []
+    for idx in range(5):
+        if ambeserver.is_tone_frame(svr.decode_ambe(bytes(9))):
+            ambeserver.add_tone_frame(tones, idx)
+
+    assert tones == [ambeserver.ToneEvent(0, 2), ambeserver.ToneEvent(4, 1)]
+
+
+class PipelineSink(ListSink):
+    """
+    Records how many packets were in flight when each response was sunk.
+    """
+
+    def __init__(self, chip):
+        super(PipelineSink, self).__init__()
+        self.chip = chip
+        self.in_flight = []
+
+    def write(self, block):
+        super(PipelineSink, self).write(block)
+        self.in_flight.append(len(self.chip.speech_packets) - len(self))
+
+
+def test_encode_tones_pipelines_schedule():
+    chip = FakeChip()
+    svr = make_server(chip)
+    sink = PipelineSink(chip)
+
+    schedule = [(5, 3, 100), (6, 3, 30), (5, 3, 20)]
+    assert svr.encode_tones(schedule, sink, depth=4) == 8
+
+    assert len(chip.speech_packets) == 8
+    assert len(sink) == 8
+    assert [r.BYTES[0] for r in sink] == list(range(1, 9))
+    assert max(sink.in_flight) == 3
+
+    # One template per distinct tone, reused for every frame of it
+    assert sorted(svr._tone_packets) == [(5, 3), (6, 3)]
+    assert chip.speech_packets[0] == svr.tone_packet(5, 3)
+    assert chip.speech_packets[0].endswith(b"\x08\x05\x03")
+    assert chip.speech_packets[5] == svr.tone_packet(6, 3)
+    assert chip.speech_packets[7] == chip.speech_packets[0]
+
+
+def test_encode_tones_drains_short_schedule():
+    chip = FakeChip()
+    svr = make_server(chip)
+    sink = ListSink()
+
+    assert svr.encode_tones([(1, 0, 40)], sink, depth=8) == 2
+    assert len(chip.speech_packets) == 2
+    assert len(sink) == 2
+    assert svr.port.read(1) == b""
+
+
+class NullSink(object):
+    def write(self, block):
+        pass
+
+
+# A decoded frame currently allocates about 11 KiB: the parsed Containers,
+# the ListContainer of 160 samples, the Computed bytes and the log strings
+ALLOC_BUDGET_PER_FRAME = 16 * 1024
+
+
+def test_decode_allocation_budget():
+    svr = make_server()
+    svr.decode_ambe_batch([bytes(9)] * 10, NullSink())
+
+    with svr.profile() as prof:
+        svr.decode_ambe_batch([bytes(9)] * 500, NullSink())
+
+    assert prof.frames == 500
+    assert 0 < prof.alloc_bytes_per_frame < ALLOC_BUDGET_PER_FRAME
+    assert prof.retained_blocks_per_frame < 0.1
+
+
+def test_profile_reports_retained_frames():
+    svr = make_server()
+    kept = ListSink()
+
+    with svr.profile() as prof:
+        svr.decode_ambe_batch([bytes(9)] * 100, kept)
+
+    assert prof.retained_blocks_per_frame >= 1
+    assert dict(prof.types).get("Container", 0) >= 100
+
+
+def test_profile_leaves_host_tracing_alone():
+    svr = make_server()
+    tracemalloc.start()
+    try:
+        with svr.profile() as prof:
+            svr.decode_ambe(bytes(9))
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    with svr.profile() as prof:
+        svr.decode_ambe(bytes(9))
+    assert not tracemalloc.is_tracing()
+
+    names = dict(prof.types)
+    for name in ("Snapshot", "StatisticDiff", "Traceback"):
+        assert name not in names
+
+
+@pytest.fixture
+def pty_pair():
+    master, slave = pty.openpty()
+    yield master, os.ttyname(slave)
+    os.close(master)
+    os.close(slave)
+
+
+def test_fd_transport_serves_small_reads_from_one_read(pty_pair, monkeypatch):
+    master, name = pty_pair
+    port = ambeserver.FdTransport(name, timeout=1.0)
+    pkt = pcm_packet()
+    os.write(master, pkt)
+    time.sleep(0.05)
+
+    reads = []
+    real_read = os.read
+
+    def counting_read(fd, size):
+        reads.append(size)
+        return real_read(fd, size)
+
+    monkeypatch.setattr(ambeserver.os, "read", counting_read)
+
+    assert port.read(1) == pkt[:1]
+    assert port.read(2) == pkt[1:3]
+    assert port.read(1) == pkt[3:4]
+    assert port.read(len(pkt) - 4) == pkt[4:]
+    assert len(reads) == 1
+    port.close()
+
+
+def test_fd_transport_read_timeout(pty_pair):
+    master, name = pty_pair
+    port = ambeserver.FdTransport(name, timeout=0.1)
+
+    start = time.monotonic()
+    assert port.read(1) == b""
+    assert time.monotonic() - start < 1.0
+    port.close()
+
+
+def test_fd_transport_write_timeout(pty_pair):
+    master, name = pty_pair
+    port = ambeserver.FdTransport(name, timeout=0.2)
+    data = bytes(1 << 20)
+
+    start = time.monotonic()
+    numout = port.write(data)
+    assert time.monotonic() - start < 2.0
+    assert 0 < numout < len(data)
+    port.close()
+
+
+def test_fd_transport_low_latency_falls_back(pty_pair, caplog):
+    master, name = pty_pair
+    with caplog.at_level(logging.WARNING, logger="Modem"):
+        port = ambeserver.FdTransport(name, low_latency=True)
+
+    messages = [r.getMessage() for r in caplog.records]
+    assert any("latency_timer" in m for m in messages)
+    assert any("ASYNC_LOW_LATENCY" in m for m in messages)
+
+    port.write(b"ok")
+    assert os.read(master, 2) == b"ok"
+    port.close()
+
+
+@pytest.mark.parametrize("udp", [False, True])
+def test_socket_transport(udp):
+    kind = socket.SOCK_DGRAM if udp else socket.SOCK_STREAM
+    server = socket.socket(socket.AF_INET, kind)
+    server.bind(("127.0.0.1", 0))
+    if not udp:
+        server.listen(1)
+
+    port = ambeserver.SocketTransport("127.0.0.1", server.getsockname()[1],
+                                      udp=udp, timeout=0.2)
+    port.write(b"ping")
+    if udp:
+        data, peer = server.recvfrom(16)
+        server.sendto(pcm_packet(), peer)
+        conn = server
+    else:
+        conn, _ = server.accept()
+        data = conn.recv(16)
+        conn.sendall(pcm_packet())
+
+    assert data == b"ping"
+    assert port.read(1) == b"\x61"
+    assert port.read(2) == pcm_packet()[1:3]
+    assert port.read(1) == b"\x02"
+    assert len(port.read(1000)) == len(pcm_packet()) - 4
+    assert port.read(1) == b""
+
+    port.close()
+    if conn is not server:
+        conn.close()
+    server.close()
+
+
+def test_loopback_transport():
+    port = ambeserver.LoopbackTransport()
+    port.timeout = 0.01
+    assert port.write(b"abc") == 3
+    assert port.read(2) == b"ab"
+    port.flush()
+    assert port.read(1) == b""